@@ -2,19 +2,169 @@
 
 import hashlib  # a module to encode the blocks (hashlib.sha256)
 import json # json : a kind of data format
+import multiprocessing # Share a stop flag between processes
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor # Run CPU-bound work (like hashing) on all the CPU cores
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait # Run blocking calls (like network requests) in parallel threads
+from functools import lru_cache # Remember the results of a function for the inputs it has already seen
 from time import time
 from urllib.parse import urlparse # urlparse('url') => returns 6-elements named-tuple (scheme, netloc, path, params, query, fragment)
 from uuid import uuid4 # uuid: 128-bit number that identifies unique Internet objects or data
 
 import requests # Need requests module to connect web URL with the local cpu
+from requests.adapters import HTTPAdapter # Keeps a pool of open connections for a requests session
+from urllib3.util.retry import Retry # Retry policy for a failed connection (urllib3 comes with requests)
 from flask import Flask, jsonify, request # flask: one of the web framework in python
+from flask.json.provider import DefaultJSONProvider # Flask's JSON encoder/decoder, used by jsonify and request.get_json
+
+try:
+    import orjson # (Optional) a JSON library written in Rust, several times faster than json for big responses like a chain
+except ImportError:
+    orjson = None
+
+# One JSON encoder shared by every 'Blockchain.hash' call. (json.dumps(..., sort_keys=True) builds a new encoder on each call.)
+# Its output is exactly the same as json.dumps(block, sort_keys=True), so the block hashes stay the same.
+block_encoder = json.JSONEncoder(sort_keys=True)
+
+# The hash function used for both the block hashes and the Proof of Work, chosen by the POW_HASH environment variable.
+#  - 'sha256' (default): the original algorithm, the same as every other node running this tutorial
+#  - 'blake3': faster than SHA-256 on large inputs (big blocks), but needs the blake3 package (pip install blake3).
+#              The short Proof of Work guesses gain nothing from it.
+# Every node in a network must use the same one, or the chains of the other nodes will never be valid.
+POW_HASH = os.environ.get('POW_HASH', 'sha256')
+if POW_HASH == 'sha256':
+    hash_function = hashlib.sha256
+elif POW_HASH == 'blake3':
+    from blake3 import blake3 as hash_function
+else:
+    raise ValueError(f'Unknown POW_HASH: {POW_HASH}')
+
+# Try every proof in [start, start + count) and return the first valid one (None if there is none)
+# It only takes bytes and ints, and touches no Blockchain state, so it can be handed to another process as it is.
+def search_proofs(prefix, suffix, start, count):
+    """
+    Searches one batch of proofs
+
+    :param prefix: <bytes> The encoded Previous Proof
+    :param suffix: <bytes> The encoded hash of the Previous Block
+    :param start: <int> First proof to try
+    :param count: <int> Number of proofs to try
+    :return: <int> The first valid proof in the batch, or None
+    """
+
+    # hashlib.sha256 is backed by OpenSSL, which already uses the CPU's SHA instructions (SHA-NI, ARMv8 crypto) when present.
+    # (blake3 uses the CPU's SIMD instructions instead.)
+    # The prefix never changes during the search, so hash it once (midstate).
+    # Each guess then only copies the midstate and feeds the new bytes.
+    # (The proof sits between the two fixed parts, so the prefix can not be padded to a 64-byte block
+    # without changing what 'valid_proof' checks.)
+    copy = hash_function(prefix).copy  # Bind the method once instead of looking it up on every guess
+    # Bake the fixed suffix into the format itself, so each guess formats a single int (no argument tuple to build).
+    guess_format = b'%d' + suffix.replace(b'%', b'%%')
+    for proof in range(start, start + count):
+        guess_hash = copy()
+        guess_hash.update(guess_format % proof)  # '%d' formatting of bytes is done in C
+        digest = guess_hash.digest()
+        # The first 4 hex digits being '0000' is the same as the first 2 bytes of the raw digest being zero
+        if digest[0] == 0 and digest[1] == 0:
+            return proof
+
+    return None
+
+
+# Search the proofs batch by batch, so the per-guess work stays inside one tight loop.
+# Every worker process runs this with its own 'worker_id': worker i tries the batches i, i + workers, i + 2 * workers, ...
+# The first worker to find a proof sets 'pow_stop_event', and the others stop after their current batch.
+def find_proof(prefix, suffix, batch_size, worker_id=0, workers=1):
+    """
+    Finds a valid proof in this worker's share of the proofs
+
+    :param prefix: <bytes> The encoded Previous Proof
+    :param suffix: <bytes> The encoded hash of the Previous Block
+    :param batch_size: <int> Number of proofs to try per batch
+    :param worker_id: <int> Index of this worker, from 0 to workers - 1
+    :param workers: <int> Number of workers sharing the search
+    :return: <int> A valid proof, or None if another worker found one first
+    """
+
+    start = worker_id * batch_size
+    while not pow_stop_event.is_set():
+        proof = search_proofs(prefix, suffix, start, batch_size)
+        if proof is not None:
+            pow_stop_event.set()
+            return proof
+        start += workers * batch_size
+
+    return None
+
+
+# Runs once in each worker process: keep the stop flag shared with the Flask server process
+def init_pow_worker(stop_event):
+    global pow_stop_event
+    pow_stop_event = stop_event
+
+
+# One HTTP session shared by every 'resolve_conflicts' call.
+# Connections to the neighbours are kept open and reused, instead of a new TCP connection per node per call.
+http_session = requests.Session()
+# Only failed connections are retried: retrying a read timeout would hold the whole consensus round for a slow node,
+# which 'resolve_conflicts' skips instead.
+http_session.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=64,
+                                          max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2)))
+
+
+# The proof of work is CPU-bound, so it runs in worker processes (one per CPU core) instead of a thread of the Flask server.
+# 'valid_chain' checks long chains in the same worker processes.
+# (The worker processes are only started when they are first needed.)
+# Count only the CPU cores this process may run on (e.g. in a container), not all the cores of the machine.
+if hasattr(os, 'process_cpu_count'): # Python 3.13+
+    pow_workers = os.process_cpu_count() or 1
+elif hasattr(os, 'sched_getaffinity'): # Linux
+    pow_workers = len(os.sched_getaffinity(0))
+else:
+    pow_workers = os.cpu_count() or 1
+pow_stop_event = multiprocessing.Event() # Set by the worker that finds a proof, to stop the others
+pow_executor = ProcessPoolExecutor(max_workers=pow_workers, initializer=init_pow_worker, initargs=(pow_stop_event,))
+pow_lock = threading.Lock() # The stop flag is shared, so only one proof of work runs at a time
+
+
+# Turn a node address into one canonical 'host:port' form, so the same node is never registered twice
+# ('http://192.168.0.5:5000', '192.168.0.5:5000', '//192.168.0.5:5000' and 'HTTP://192.168.0.5:5000/' are all the same node).
+# The same addresses are registered again and again, so the parsed results are cached.
+@lru_cache(maxsize=4096)
+def canonical_node_address(address):
+    """
+    Normalizes the address of a node
+
+    :param address: <str> Address of node. Eg. 'http://192.168.0.5:5000', '//192.168.0.5:5000' or '192.168.0.5:5000'
+    :return: <str> The canonical address. Eg. '192.168.0.5:5000'
+    """
+
+    # Give an URL without scheme like '192.168.0.5:5000' a leading '//', so urlparse puts the host into netloc.
+    # (A scheme-relative address like '//192.168.0.5:5000' already has one.)
+    has_netloc_marker = '://' in address or address.startswith('//')
+    parsed_url = urlparse(address if has_netloc_marker else '//' + address)
+    canonical = (parsed_url.netloc or parsed_url.path).lower()
+    # In case any of url netloc or path does not exist, show the error message 'Invalid URL'.
+    if not canonical:
+        raise ValueError('Invalid URL')
+    return canonical
+
 
 # A huge class 'Blockchain'
 class Blockchain:
+    # Number of proofs tried per batch in 'proof_of_work' (workers check the stop flag between batches)
+    POW_BATCH_SIZE = 4096
+    # Chains longer than this are checked in parallel by 'valid_chain'
+    PARALLEL_VERIFY_MIN_LENGTH = 5000
+
     def __init__(self):
         # All three objects below would be used later to specify blockchain elements
-        self.current_transactions = [] # A list to save transactions
+        self.current_transactions = [] # A list to save transactions, as (transaction, its JSON text) pairs
+        self.transactions_lock = threading.Lock() # Guards 'current_transactions' against the Flask server's other threads
         self.chain = [] # A list to save chain
+        self.last_block_hash = None # The hash of the last block in the chain, kept up to date by 'new_block'
         self.nodes = set() # A set to save unique nodes
         # Create the genesis block (The first block of a blockchain)
         self.new_block(previous_hash='1', proof=100)
@@ -26,28 +176,34 @@ class Blockchain:
 
         :param address: Address of node. Eg. 'http://192.168.0.5:5000'
         """
-        # In case parsed netloc exists, add netloc information to nodes, otherwise, add path info.
-        # In case any of url netloc or path does not exist, show the error message 'Invalid URL'.
-        parsed_url = urlparse(address)
-        if parsed_url.netloc:
-            self.nodes.add(parsed_url.netloc)
-        elif parsed_url.path:
-            # Accepts an URL without scheme like '192.168.0.5:5000'.
-            self.nodes.add(parsed_url.path)
-        else:
-            raise ValueError('Invalid URL')
+        self.nodes.add(canonical_node_address(address))
 
     # Inspect whether this blockchain is valid or not
-    def valid_chain(self, chain):
+    def valid_chain(self, chain, start=0):
         """
         Determine if a given blockchain is valid
 
         :param chain: A blockchain
+        :param start: <int> (Optional) Number of leading blocks already known to be valid, which are not checked again
         :return: True if valid, False if not
         """
 
-        last_block = chain[0]
-        current_index = 1
+        # The first block to check is linked to the last trusted block (or to the genesis block)
+        current_index = max(start, 1)
+
+        # Every link (block i, block i+1) can be checked on its own, so a long chain is split over the worker processes
+        # of 'pow_executor'. Sending the blocks to the workers costs more than checking a short chain,
+        # so short chains are still checked here.
+        if len(chain) - current_index > self.PARALLEL_VERIFY_MIN_LENGTH:
+            links = zip(chain[current_index - 1:], chain[current_index:])
+            results = pow_executor.map(self._verify_link, links, chunksize=64)
+            try:
+                return all(results)
+            finally:
+                # Cancel the links not checked yet as soon as one invalid link is found
+                results.close()
+
+        last_block = chain[current_index - 1]
 
         # Inspect all the series of blocks in a blockchain
         while current_index < len(chain):
@@ -75,6 +231,21 @@ class Blockchain:
 
         return True
 
+    # Check one link of a blockchain: used by 'valid_chain' to check the links of a long chain in worker processes
+    @staticmethod
+    def _verify_link(link):
+        """
+        Determine if a block is correctly linked to the previous block
+
+        :param link: <tuple> (Previous Block, Block)
+        :return: <bool> True if valid, False if not
+        """
+
+        last_block, block = link
+        last_block_hash = Blockchain.hash(last_block)
+        return (block['previous_hash'] == last_block_hash
+                and Blockchain.valid_proof(last_block['proof'], block['proof'], last_block_hash))
+
     # In case of generating the same decoded hash at the same time, will choose the chain which is longer cuz its more believable.
     # Solution to 'Fork' problem in blockchain
     def resolve_conflicts(self):
@@ -91,22 +262,56 @@ class Blockchain:
         # We're only looking for chains longer than ours
         max_length = len(self.chain)
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-
-            if response.status_code == 200: # server response success
-                length = response.json()['length']
-                chain = response.json()['chain']
-
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+        if not neighbours:
+            return False
+
+        # Grab the chains from all the nodes in our network at the same time,
+        # so the waiting time is about the slowest node's round trip instead of the sum of all of them.
+        candidates = []
+        with ThreadPoolExecutor(max_workers=min(32, len(neighbours))) as executor:
+            # (timeout: 2 seconds to connect, 10 seconds to read the chain)
+            futures = [executor.submit(http_session.get, f'http://{node}/chain', timeout=(2, 10)) for node in neighbours]
+
+            for future in as_completed(futures):
+                # A neighbour that is down, too slow, or sends a broken body is skipped for this round
+                try:
+                    response = future.result()
+                except requests.RequestException:
+                    continue
+
+                if response.status_code == 200: # server response success
+                    try:
+                        data = response.json() # Parse the body only once
+                        length = data['length']
+                        chain = data['chain']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+                    # Keep only the chains longer than ours
+                    if length > max_length:
+                        candidates.append((length, chain))
+
+        # Verify the longest chains first. The first valid one is the longest valid chain, so the rest need no check.
+        for length, chain in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+            # Nodes that already agreed on a chain share its first blocks, and our own blocks are known to be valid.
+            # So find where the chain diverges from ours, and only verify the blocks from there on.
+            shared = 0
+            for our_block, block in zip(self.chain, chain):
+                if our_block != block:
+                    break
+                shared += 1
+            # Keep our own block objects for the shared part. (Comparing dicts treats 1 and 1.0 as equal, but
+            # their JSON text differs, so this makes sure the trusted blocks hash exactly like ours.)
+            chain[:shared] = self.chain[:shared]
+
+            if self.valid_chain(chain, start=shared):
+                new_chain = chain
+                break
 
         # Replace our chain if we discovered a new, valid chain longer than ours
         if new_chain:
             self.chain = new_chain
+            self.last_block_hash = self.hash(new_chain[-1])
             return True
 
         # If there's no conflict or the longer one is not found, no need to update the chain.
@@ -122,16 +327,23 @@ class Blockchain:
         :return: New Block
         """
 
+        # Take the current list of transactions and reset it in one step. The Flask server keeps adding transactions
+        # from other threads, so the block and its hash must both be built from this one list.
+        with self.transactions_lock:
+            transactions, self.current_transactions = self.current_transactions, []
+
         block = {
             'index': len(self.chain) + 1,
             'timestamp': time(),
-            'transactions': self.current_transactions,
+            'transactions': [transaction for transaction, _ in transactions],
             'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            'previous_hash': previous_hash or self.last_block_hash,
         }
 
-        # Reset the current list of transactions
-        self.current_transactions = []
+        # Hash the new block now, while the JSON text of each of its transactions is at hand.
+        # 'proof_of_work' needs this hash for the next block, and only the block header has to be serialized for it.
+        transactions_json = '[' + ', '.join(text for _, text in transactions) + ']'
+        self.last_block_hash = self.hash(block, transactions_json)
 
         self.chain.append(block)
         return block
@@ -146,11 +358,15 @@ class Blockchain:
         :param amount: Amount
         :return: The index of the Block that will hold this transaction
         """
-        self.current_transactions.append({
+        transaction = {
             'sender': sender,
             'recipient': recipient,
             'amount': amount,
-        })
+        }
+        # Serialize the transaction only once, here. Hashing its block later just joins these texts.
+        transaction_json = block_encoder.encode(transaction)
+        with self.transactions_lock:
+            self.current_transactions.append((transaction, transaction_json))
 
         return self.last_block['index'] + 1
 
@@ -160,17 +376,24 @@ class Blockchain:
         return self.chain[-1]
 
     @staticmethod
-    # Hash the block using Sha-256 method
-    def hash(block):
+    # Hash the block using Sha-256 method (or BLAKE3, see POW_HASH)
+    def hash(block, transactions_json=None):
         """
-        Creates a SHA-256 hash of a Block
+        Creates a SHA-256 (or BLAKE3) hash of a Block
 
         :param block: Block
+        :param transactions_json: <str> (Optional) The block's transactions, already serialized like block_encoder does
         """
 
         # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        if transactions_json is None:
+            block_string = block_encoder.encode(block).encode()
+        else:
+            # 'transactions' is the last key in sorted order, so the header's JSON text is closed by the transactions.
+            # The result is the same text as block_encoder.encode(block).
+            header = {key: value for key, value in block.items() if key != 'transactions'}
+            block_string = (block_encoder.encode(header)[:-1] + ', "transactions": ' + transactions_json + '}').encode()
+        return hash_function(block_string).hexdigest()
 
     # Find the nonce which can make first 4 digits of hashed value as '0000'
     def proof_of_work(self, last_block):
@@ -181,17 +404,28 @@ class Blockchain:
          - Where p is the previous proof, and p' is the new proof
          
         :param last_block: <dict> last Block
-        :return: <int>
+        :return: <tuple> The new proof, and the hash of the last Block (so callers need not hash it again)
         """
 
         last_proof = last_block['proof']
-        last_hash = self.hash(last_block)
+        # The hash of our own last block was already computed by 'new_block'
+        last_hash = self.last_block_hash if last_block is self.last_block else self.hash(last_block)
+
+        # 'last_proof' and 'last_hash' never change during the search, so encode them once
+        prefix = f'{last_proof}'.encode()
+        suffix = last_hash.encode()
 
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
+        # Split the search over the worker processes and take the first proof found.
+        # Meanwhile the Flask server can keep answering other requests, since the hashing does not hold our GIL.
+        with pow_lock:
+            pow_stop_event.clear()
+            futures = [pow_executor.submit(find_proof, prefix, suffix, self.POW_BATCH_SIZE, worker_id, pow_workers)
+                       for worker_id in range(pow_workers)]
+            proof = next(future.result() for future in as_completed(futures) if future.result() is not None)
+            # Wait for the other workers to stop, so none of them is still running when the flag is cleared next time
+            wait(futures)
 
-        return proof
+        return proof, last_hash
 
     # Would return True only if the first 4 digits of hashed value are '0000'
     @staticmethod
@@ -207,13 +441,35 @@ class Blockchain:
         """
 
         guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        guess_hash = hash_function(guess).digest()
+        # The first 4 hex digits being '0000' is the same as the first 2 bytes of the raw digest being zero,
+        # so there is no need to build the 64-character hex string.
+        return guess_hash[0] == 0 and guess_hash[1] == 0
+
+
+# Let Flask's jsonify use orjson, which is much faster on big responses like '/chain'.
+# '/chain' carries the blocks other nodes hash, so the output must hold exactly the same values as Flask's default.
+# orjson refuses an int bigger than 64 bits and silently writes NaN/Infinity as null, so its output is read back
+# and compared with the original; anything it can not represent exactly goes through Flask's default provider.
+# Request bodies are still parsed by the default provider: they are small, and orjson would turn an int bigger than
+# 64 bits into a float.
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        try:
+            text = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+
+        if orjson.loads(text) != obj:
+            return super().dumps(obj, **kwargs)
+        return text.decode()
 
 
 # Instantiate the Node
 # Making Flask module available in Python under the variable name 'app'
 app = Flask(__name__)
+if orjson:
+    app.json = ORJSONProvider(app)
 
 # Generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
@@ -227,7 +483,9 @@ blockchain = Blockchain()
 def mine():
     # We run the proof of work algorithm to get the next proof...
     last_block = blockchain.last_block # Indicates the last block in the blockchain
-    proof = blockchain.proof_of_work(last_block)  # Get the nonce of last block which makes the first 4 digits of hashed value '0000'
+    # Get the nonce of last block which makes the first 4 digits of hashed value '0000'.
+    # Hashing the last block's block header is already done here, so keep that value to use as next new block's 'previous hash'.
+    proof, previous_hash = blockchain.proof_of_work(last_block)
 
     # We must receive a reward for finding the proof.
     # The sender is "0" to signify that this node has mined a new coin.
@@ -238,7 +496,6 @@ def mine():
     )
 
     # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block) # Hashing the last block's block header to use this value as next new block's 'previous hash'.
     block = blockchain.new_block(proof, previous_hash) # Block is a new object, so total length of chain increase one unit.
 
     response = {